@@ -1,16 +1,30 @@
 #!/usr/bin/env python3
 import argparse
+import copy
+import functools
 import json
+import os
 import shutil
+import stat
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 
 ROOT = Path(__file__).resolve().parent
 SRC_DIR = ROOT / "files"
 DEFAULT_HOME = Path.home()
 DEFAULT_BACKUP_PARENT = ROOT / "backups"
 BACKUP_PREFIX = "opencode-migration-"
+COPY_WORKERS = 8
+CONFIG_FILE = ".config/opencode/opencode.json"
+pending_removals: list[Future] = []
 
 PROMPT_FILES = [
     ".opencode/prompts/build-gpt-5.2-codex.md",
@@ -24,53 +38,129 @@ PROMPT_FILES = [
     ".opencode/prompts/personalities/gpt-5.2-codex_friendly.md",
     ".opencode/prompts/personalities/gpt-5.2-codex_pragmatic.md",
 ]
+PROMPT_PARENT_DIRS = sorted({os.path.dirname(rel_path) for rel_path in PROMPT_FILES})
 
 
-def ensure_parent(path: Path) -> None:
-    path.parent.mkdir(parents=True, exist_ok=True)
+def maybe_backup(backup_root: Path, rel_path: str | Path, home: Path) -> None:
+    target = os.path.join(home, rel_path)
+    if not os.path.exists(target):
+        return
+    backup = os.path.join(backup_root, rel_path)
+    os.makedirs(os.path.dirname(backup), exist_ok=True)
+    shutil.copy2(target, backup)
 
 
-def backup_path(backup_root: Path, target: Path, home: Path) -> Path:
-    relative = target.relative_to(home)
-    return backup_root / relative
+def index_files(root: Path) -> set[str]:
+    # One scandir walk yields every file under root as a POSIX relative path,
+    # so main() can check the manifest without a stat call per file.
+    # Symlinked directories are followed; each directory is listed once by
+    # (st_dev, st_ino) so a symlink loop cannot make the walk run forever.
+    found = set()
+    visited = set()
+    pending = [(os.fspath(root), "")]
+    while pending:
+        directory, prefix = pending.pop()
+        directory_stat = os.stat(directory)
+        key = (directory_stat.st_dev, directory_stat.st_ino)
+        if key in visited:
+            continue
+        visited.add(key)
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                rel_path = f"{prefix}{entry.name}"
+                if entry.is_dir():
+                    pending.append((entry.path, f"{rel_path}/"))
+                elif entry.is_file():
+                    found.add(rel_path)
+    return found
 
 
-def maybe_backup(backup_root: Path, target: Path, home: Path) -> None:
-    if not target.exists():
-        return
-    backup = backup_path(backup_root, target, home)
-    ensure_parent(backup)
-    shutil.copy2(target, backup)
+class StdlibJSON(dict):
+    # A config that needed the stdlib parser is written back with the stdlib
+    # too: orjson would turn NaN into null and cannot encode the big ints.
+    pass
 
 
-def copy_with_backup(
-    backup_root: Path, rel_path: str, home: Path, skip_backup: bool
-) -> None:
-    src = SRC_DIR / rel_path
-    dst = home / rel_path
-    if not src.is_file():
-        raise FileNotFoundError(f"Missing source file: {src}")
-    if not skip_backup:
-        maybe_backup(backup_root, dst, home)
-    ensure_parent(dst)
-    shutil.copy2(src, dst)
+def contains_float(value: object) -> bool:
+    if isinstance(value, float):
+        return True
+    if isinstance(value, dict):
+        return any(contains_float(item) for item in value.values())
+    if isinstance(value, list):
+        return any(contains_float(item) for item in value)
+    return False
 
 
 def load_json(path: Path) -> dict:
-    if not path.exists():
+    try:
+        raw = path.read_bytes()
+    except FileNotFoundError:
         return {}
-    with path.open("r", encoding="utf-8") as handle:
-        return json.load(handle)
+    if orjson is not None:
+        try:
+            data = orjson.loads(raw)
+        except orjson.JSONDecodeError:
+            # orjson is strict RFC 8259; the stdlib also accepts NaN and
+            # Infinity, so let it decide whether the config is really invalid.
+            pass
+        else:
+            # orjson reads integers wider than 64 bits as floats, so only
+            # trust its result when there are no floats to misread.
+            if not contains_float(data):
+                return data
+    data = json.loads(raw)
+    return StdlibJSON(data) if isinstance(data, dict) else data
 
 
 def save_json(path: Path, data: dict) -> None:
-    ensure_parent(path)
-    with path.open("w", encoding="utf-8") as handle:
-        json.dump(data, handle, indent=2, sort_keys=False)
-        handle.write("\n")
-
-
-def merge_config(target: dict, source: dict) -> dict:
+    payload = None
+    if orjson is not None and not isinstance(data, StdlibJSON):
+        try:
+            payload = orjson.dumps(
+                data, option=orjson.OPT_INDENT_2 | orjson.OPT_APPEND_NEWLINE
+            )
+        except orjson.JSONEncodeError:
+            pass
+    if payload is None:
+        # ensure_ascii=False matches orjson, which writes non-ASCII as UTF-8.
+        payload = (
+            json.dumps(data, indent=2, sort_keys=False, ensure_ascii=False) + "\n"
+        ).encode("utf-8")
+    # Write through symlinks and keep the existing file mode. When replacing
+    # a file, the temp file starts private and gets that mode before any bytes
+    # land, so a 0600 config is never exposed; a new config gets the usual
+    # umask-derived mode. fsync before the atomic replace means a crash
+    # leaves either the old or the new config, never a truncated one.
+    target = Path(os.path.realpath(path))
+    tmp = target.with_name(f"{target.name}.tmp")
+    try:
+        mode = stat.S_IMODE(os.stat(target).st_mode)
+    except FileNotFoundError:
+        mode = None
+    # A stale temp file would keep its old mode, so always create a fresh one.
+    tmp.unlink(missing_ok=True)
+    fd = os.open(
+        tmp,
+        os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+        0o666 if mode is None else 0o600,
+    )
+    try:
+        try:
+            if mode is not None:
+                os.chmod(tmp, mode)
+            view = memoryview(payload)
+            while view:
+                view = view[os.write(fd, view) :]
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.replace(tmp, target)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+
+
+def merge_config(target: dict, source: dict, home: Path) -> dict:
     if "$schema" not in target and "$schema" in source:
         target["$schema"] = source["$schema"]
 
@@ -83,43 +173,64 @@ def merge_config(target: dict, source: dict) -> dict:
     if not isinstance(target["agent"], dict):
         raise ValueError("Target opencode.json has a non-object 'agent' field.")
 
+    # Prompt paths are resolved as each agent is copied, and agents that
+    # already match are left alone, so a re-apply leaves target untouched.
+    existing = target["agent"]
     for name, spec in source_agents.items():
-        target["agent"][name] = spec
+        if isinstance(spec, dict) and isinstance(spec.get("prompt"), str):
+            spec = {**spec, "prompt": resolve_prompt(spec["prompt"], home)}
+        if existing.get(name) != spec:
+            existing[name] = spec
 
     return target
 
 
+@functools.lru_cache(maxsize=None)
 def resolve_prompt(prompt_value: str, home: Path) -> str:
     if not prompt_value.startswith("{file:"):
         return prompt_value
     if not prompt_value.endswith("}"):
         return prompt_value
     inner = prompt_value[len("{file:") : -1].strip()
+    # String-only equivalent of Path.resolve(): realpath still follows
+    # symlinks below home (e.g. ~/.opencode -> /elsewhere), so the output
+    # matches what earlier versions wrote, without building Path objects.
     if inner.startswith("~"):
-        resolved = Path(inner).expanduser().resolve()
-        return f"{{file:{resolved.as_posix()}}}"
-    inner_path = Path(inner)
-    if inner_path.is_absolute():
+        resolved = os.path.realpath(os.path.expanduser(inner))
+    elif os.path.isabs(inner):
         return prompt_value
-    cleaned = inner[2:] if inner.startswith("./") else inner
-    resolved = (home / cleaned).resolve()
-    return f"{{file:{resolved.as_posix()}}}"
+    else:
+        cleaned = inner[2:] if inner.startswith("./") else inner
+        resolved = os.path.realpath(os.path.join(os.fspath(home), cleaned))
+    return f"{{file:{resolved.replace(os.sep, '/')}}}"
 
 
-def apply_prompt_paths(target: dict, source: dict, home: Path) -> None:
-    source_agents = source.get("agent", {})
-    if not isinstance(source_agents, dict):
-        return
-    target_agents = target.get("agent", {})
-    if not isinstance(target_agents, dict):
-        return
-    for name, spec in source_agents.items():
-        target_spec = target_agents.get(name)
-        if not isinstance(target_spec, dict):
-            continue
-        prompt_value = spec.get("prompt")
-        if isinstance(prompt_value, str):
-            target_spec["prompt"] = resolve_prompt(prompt_value, home)
+@functools.lru_cache(maxsize=None)
+def removal_pool() -> ThreadPoolExecutor:
+    # Created on first use so runs that never replace a tree start no thread.
+    return ThreadPoolExecutor(max_workers=1)
+
+
+def remove_tree_in_background(path: Path) -> None:
+    # Renaming is a single syscall, so the caller can reuse the path at once
+    # while the actual unlinking runs on a worker thread. Failures are kept on
+    # the future and re-raised by wait_for_removals, so a tombstone that could
+    # not be deleted is never left behind silently.
+    tombstone = path.with_name(f"{path.name}.old-{uuid.uuid4().hex}")
+    os.rename(path, tombstone)
+    pending_removals.append(removal_pool().submit(shutil.rmtree, tombstone))
+
+
+def wait_for_removals() -> None:
+    # Let every removal finish before raising, so none is left unchecked.
+    errors = []
+    while pending_removals:
+        try:
+            pending_removals.pop().result()
+        except OSError as exc:
+            errors.append(exc)
+    if errors:
+        raise errors[0]
 
 
 def backup_directory(backup_root: Path, target_dir: Path, home: Path) -> bool:
@@ -127,12 +238,31 @@ def backup_directory(backup_root: Path, target_dir: Path, home: Path) -> bool:
         return False
     backup_dir = backup_root / target_dir.relative_to(home)
     if backup_dir.exists():
-        shutil.rmtree(backup_dir)
+        remove_tree_in_background(backup_dir)
     backup_dir.parent.mkdir(parents=True, exist_ok=True)
+    # Copy rather than move so the live tree, and any open files in it, is
+    # never touched. Symlinks are followed: apply writes through a linked
+    # prompt, so the backup must hold the content, not just the link.
     shutil.copytree(target_dir, backup_dir)
     return True
 
 
+def copy_prompt_files(home: Path) -> None:
+    # Copy only the manifest, so unapply can remove everything apply wrote,
+    # and never touch the metadata of directories the user already has.
+    # Parents are created up front so the pooled copies never race on mkdir.
+    for rel_dir in PROMPT_PARENT_DIRS:
+        os.makedirs(os.path.join(home, rel_dir), exist_ok=True)
+    with ThreadPoolExecutor(max_workers=COPY_WORKERS) as executor:
+        list(
+            executor.map(
+                shutil.copy2,
+                [os.path.join(SRC_DIR, rel_path) for rel_path in PROMPT_FILES],
+                [os.path.join(home, rel_path) for rel_path in PROMPT_FILES],
+            )
+        )
+
+
 def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser(description="Apply OpenCode prompt migration.")
     parser.add_argument(
@@ -159,45 +289,63 @@ def parse_args() -> argparse.Namespace:
 
 
 def main() -> int:
-    args = parse_args()
-    home = Path(args.home).expanduser().resolve()
-    target_config = home / ".config" / "opencode" / "opencode.json"
-
-    if not SRC_DIR.exists():
-        print(f"Missing migration folder: {SRC_DIR}")
-        return 1
-
-    if args.backup_dir:
-        backup_root = Path(args.backup_dir).expanduser().resolve()
-    else:
-        backup_parent = Path(args.backup_parent).expanduser().resolve()
-        backup_root = backup_parent / f"{args.backup_prefix}{datetime.now().strftime('%Y%m%d-%H%M%S')}"
-
-    source_config = SRC_DIR / "opencode.json"
-    if not source_config.is_file():
-        print(f"Missing source config: {source_config}")
-        return 1
-
-    backup_root.mkdir(parents=True, exist_ok=True)
-    backed_up_opencode = backup_directory(backup_root, home / ".opencode", home)
-    backed_up_config = backup_directory(
-        backup_root, home / ".config" / "opencode", home
-    )
-
-    target_config_data = load_json(target_config)
-    source_data = load_json(source_config)
-    if not backed_up_config:
-        maybe_backup(backup_root, target_config, home)
-    merged = merge_config(target_config_data, source_data)
-    apply_prompt_paths(merged, source_data, home)
-    save_json(target_config, merged)
-
-    skip_backup = backed_up_opencode
-    for rel_path in PROMPT_FILES:
-        copy_with_backup(backup_root, rel_path, home, skip_backup)
-
-    print("Reapplied OpenCode prompt migration files.")
-    return 0
+    # Always collect background removals, so a failed tombstone delete is
+    # reported even when main() bails out early with an exception.
+    try:
+        args = parse_args()
+        home = Path(args.home).expanduser().resolve()
+        target_config = home / CONFIG_FILE
+
+        try:
+            source_files = index_files(SRC_DIR)
+        except (FileNotFoundError, NotADirectoryError):
+            print(f"Missing migration folder: {SRC_DIR}")
+            return 1
+
+        if args.backup_dir:
+            backup_root = Path(args.backup_dir).expanduser().resolve()
+        else:
+            backup_parent = Path(args.backup_parent).expanduser().resolve()
+            backup_root = backup_parent / f"{args.backup_prefix}{datetime.now().strftime('%Y%m%d-%H%M%S')}"
+
+        source_config = SRC_DIR / "opencode.json"
+        if "opencode.json" not in source_files:
+            print(f"Missing source config: {source_config}")
+            return 1
+        for rel_path in PROMPT_FILES:
+            if rel_path not in source_files:
+                print(f"Missing source file: {SRC_DIR / rel_path}")
+                return 1
+
+        backup_root.mkdir(parents=True, exist_ok=True)
+        backup_directory(backup_root, home / ".opencode", home)
+        backed_up_config = backup_directory(
+            backup_root, home / ".config" / "opencode", home
+        )
+
+        # Created after the backups so a fresh home is not snapshotted with an
+        # empty config directory; save_json relies on it existing.
+        target_config.parent.mkdir(parents=True, exist_ok=True)
+        source_data = load_json(source_config)
+        # A missing target loads as {}; merging the source into it always differs
+        # from the empty original, so a fresh install is written like any other.
+        target_config_data = load_json(target_config)
+        original = copy.deepcopy(target_config_data)
+        merged = merge_config(target_config_data, source_data, home)
+        if merged == original:
+            print("OpenCode config unchanged.")
+        else:
+            if not backed_up_config:
+                maybe_backup(backup_root, CONFIG_FILE, home)
+            save_json(target_config, merged)
+
+        copy_prompt_files(home)
+
+        wait_for_removals()
+        print("Reapplied OpenCode prompt migration files.")
+        return 0
+    finally:
+        wait_for_removals()
 
 
 if __name__ == "__main__":
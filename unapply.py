@@ -1,9 +1,19 @@
 #!/usr/bin/env python3
 import argparse
+import functools
 import json
+import os
 import shutil
+import stat
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 
 ROOT = Path(__file__).resolve().parent
 BACKUP_ROOT = ROOT / "backups"
@@ -24,55 +34,170 @@ PROMPT_FILES = [
     ".opencode/prompts/personalities/gpt-5.2-codex_friendly.md",
     ".opencode/prompts/personalities/gpt-5.2-codex_pragmatic.md",
 ]
+PROMPT_PARENT_DIRS = sorted({os.path.dirname(rel_path) for rel_path in PROMPT_FILES})
+pending_removals: list[Future] = []
+latest_backup_cache: dict[tuple[str, str], tuple[int, Path | None]] = {}
+
+
+class StdlibJSON(dict):
+    # A config that needed the stdlib parser is written back with the stdlib
+    # too: orjson would turn NaN into null and cannot encode the big ints.
+    pass
+
+
+def contains_float(value: object) -> bool:
+    if isinstance(value, float):
+        return True
+    if isinstance(value, dict):
+        return any(contains_float(item) for item in value.values())
+    if isinstance(value, list):
+        return any(contains_float(item) for item in value)
+    return False
 
 
 def load_json(path: Path) -> dict:
-    if not path.exists():
+    try:
+        raw = path.read_bytes()
+    except FileNotFoundError:
         return {}
-    with path.open("r", encoding="utf-8") as handle:
-        return json.load(handle)
+    if orjson is not None:
+        try:
+            data = orjson.loads(raw)
+        except orjson.JSONDecodeError:
+            # orjson is strict RFC 8259; the stdlib also accepts NaN and
+            # Infinity, so let it decide whether the config is really invalid.
+            pass
+        else:
+            # orjson reads integers wider than 64 bits as floats, so only
+            # trust its result when there are no floats to misread.
+            if not contains_float(data):
+                return data
+    data = json.loads(raw)
+    return StdlibJSON(data) if isinstance(data, dict) else data
 
 
 def save_json(path: Path, data: dict) -> None:
-    path.parent.mkdir(parents=True, exist_ok=True)
-    with path.open("w", encoding="utf-8") as handle:
-        json.dump(data, handle, indent=2, sort_keys=False)
-        handle.write("\n")
-
-
-def remove_empty_dirs(path: Path, stop: Path) -> None:
-    current = path
-    while current != stop and current != current.parent:
+    payload = None
+    if orjson is not None and not isinstance(data, StdlibJSON):
+        try:
+            payload = orjson.dumps(
+                data, option=orjson.OPT_INDENT_2 | orjson.OPT_APPEND_NEWLINE
+            )
+        except orjson.JSONEncodeError:
+            pass
+    if payload is None:
+        # ensure_ascii=False matches orjson, which writes non-ASCII as UTF-8.
+        payload = (
+            json.dumps(data, indent=2, sort_keys=False, ensure_ascii=False) + "\n"
+        ).encode("utf-8")
+    # Write through symlinks and keep the existing file mode. When replacing
+    # a file, the temp file starts private and gets that mode before any bytes
+    # land, so a 0600 config is never exposed; a new config gets the usual
+    # umask-derived mode. fsync before the atomic replace means a crash
+    # leaves either the old or the new config, never a truncated one.
+    target = Path(os.path.realpath(path))
+    tmp = target.with_name(f"{target.name}.tmp")
+    try:
+        mode = stat.S_IMODE(os.stat(target).st_mode)
+    except FileNotFoundError:
+        mode = None
+    # A stale temp file would keep its old mode, so always create a fresh one.
+    tmp.unlink(missing_ok=True)
+    fd = os.open(
+        tmp,
+        os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+        0o666 if mode is None else 0o600,
+    )
+    try:
         try:
-            current.rmdir()
+            if mode is not None:
+                os.chmod(tmp, mode)
+            view = memoryview(payload)
+            while view:
+                view = view[os.write(fd, view) :]
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.replace(tmp, target)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+
+
+def remove_empty_dirs(path: str | Path, stop: str | Path) -> None:
+    current = os.fspath(path)
+    stop = os.fspath(stop)
+    while current != stop and current != os.path.dirname(current):
+        try:
+            os.rmdir(current)
         except OSError:
             break
-        current = current.parent
+        current = os.path.dirname(current)
+
+
+def scan_latest_backup_dir(parent: Path, prefix: str) -> Path | None:
+    latest = None
+    with os.scandir(parent) as entries:
+        for entry in entries:
+            if not entry.name.startswith(prefix) or not entry.is_dir():
+                continue
+            if latest is None or entry.name > latest.name:
+                latest = entry
+    return Path(latest.path) if latest else None
 
 
 def latest_backup_dir(parent: Path, prefix: str) -> Path | None:
-    if not parent.exists():
+    # Adding or removing a backup changes the parent's mtime, so a cached
+    # answer stays valid for as long as that mtime does.
+    try:
+        mtime_ns = parent.stat().st_mtime_ns
+    except FileNotFoundError:
         return None
-    candidates = [
-        p for p in parent.iterdir() if p.is_dir() and p.name.startswith(prefix)
-    ]
-    if not candidates:
+    key = (str(parent), prefix)
+    cached = latest_backup_cache.get(key)
+    if cached is not None and cached[0] == mtime_ns:
+        return cached[1]
+    try:
+        result = scan_latest_backup_dir(parent, prefix)
+    except FileNotFoundError:
         return None
-    return sorted(candidates)[-1]
+    latest_backup_cache[key] = (mtime_ns, result)
+    return result
+
+
+def matches_backup(backup_stat: os.stat_result, target: str) -> bool:
+    # copy2 preserves mtime, so a target with the backup's size and mtime
+    # is one we already restored and can skip copying again.
+    try:
+        target_stat = os.stat(target)
+    except FileNotFoundError:
+        return False
+    return target_stat.st_size == backup_stat.st_size and int(
+        target_stat.st_mtime
+    ) == int(backup_stat.st_mtime)
 
 
 def restore_from_backup(backup_dir: Path, rel_path: str, home: Path) -> None:
-    backup_path = backup_dir / rel_path
-    target = home / rel_path
-    if backup_path.exists():
-        target.parent.mkdir(parents=True, exist_ok=True)
-        shutil.copy2(backup_path, target)
-    elif target.exists():
-        if target.is_dir():
-            shutil.rmtree(target)
-        else:
-            target.unlink()
-        remove_empty_dirs(target.parent, home)
+    backup_path = os.path.join(backup_dir, rel_path)
+    target = os.path.join(home, rel_path)
+    try:
+        backup_stat = os.stat(backup_path)
+    except FileNotFoundError:
+        pass
+    else:
+        if not matches_backup(backup_stat, target):
+            shutil.copy2(backup_path, target)
+        return
+    # One lstat answers both "does it exist" and "is it a directory".
+    try:
+        target_mode = os.lstat(target).st_mode
+    except FileNotFoundError:
+        return
+    if stat.S_ISDIR(target_mode):
+        shutil.rmtree(target)
+    else:
+        os.unlink(target)
+    remove_empty_dirs(os.path.dirname(target), home)
 
 
 def remove_agents_from_config(
@@ -101,13 +226,41 @@ def remove_agents_from_config(
         else:
             save_json(target_config, target_data)
 
+@functools.lru_cache(maxsize=None)
+def removal_pool() -> ThreadPoolExecutor:
+    # Created on first use so runs that never replace a tree start no thread.
+    return ThreadPoolExecutor(max_workers=1)
+
+
+def remove_tree_in_background(path: Path) -> None:
+    # Renaming is a single syscall, so the caller can reuse the path at once
+    # while the actual unlinking runs on a worker thread. Failures are kept on
+    # the future and re-raised by wait_for_removals, so a tombstone that could
+    # not be deleted is never left behind silently.
+    tombstone = path.with_name(f"{path.name}.old-{uuid.uuid4().hex}")
+    os.rename(path, tombstone)
+    pending_removals.append(removal_pool().submit(shutil.rmtree, tombstone))
+
+
+def wait_for_removals() -> None:
+    # Let every removal finish before raising, so none is left unchecked.
+    errors = []
+    while pending_removals:
+        try:
+            pending_removals.pop().result()
+        except OSError as exc:
+            errors.append(exc)
+    if errors:
+        raise errors[0]
+
+
 def restore_dir(backup_dir: Path, rel_path: str, home: Path) -> bool:
     source = backup_dir / rel_path
     target = home / rel_path
     if not source.exists():
         return False
     if target.exists():
-        shutil.rmtree(target)
+        remove_tree_in_background(target)
     target.parent.mkdir(parents=True, exist_ok=True)
     shutil.copytree(source, target)
     return True
@@ -139,49 +292,63 @@ def parse_args() -> argparse.Namespace:
 
 
 def main() -> int:
-    args = parse_args()
-    home = Path(args.home).expanduser().resolve()
-    target_config = home / ".config" / "opencode" / "opencode.json"
-
-    source_config = SRC_DIR / "opencode.json"
-    source_data = load_json(source_config)
-    agent_names = set(source_data.get("agent", {}).keys())
-
-    if args.backup_dir:
-        backup_dir = Path(args.backup_dir).expanduser().resolve()
-    else:
-        backup_parent = Path(args.backup_parent).expanduser().resolve()
-        backup_dir = latest_backup_dir(backup_parent, args.backup_prefix)
-
-    if backup_dir and backup_dir.exists():
-        restored_opencode = restore_dir(backup_dir, ".opencode", home)
-        restored_config = restore_dir(backup_dir, ".config/opencode", home)
-
-        if not restored_config:
-            backup_config = backup_dir / ".config/opencode/opencode.json"
-            if backup_config.exists():
-                restore_from_backup(backup_dir, ".config/opencode/opencode.json", home)
-            else:
-                remove_agents_from_config(agent_names, target_config, home)
-
-        if not restored_opencode:
-            for rel_path in PROMPT_FILES:
-                restore_from_backup(backup_dir, rel_path, home)
-
-        print(f"Restored from backup: {backup_dir}")
+    # Always collect background removals, so a failed tombstone delete is
+    # reported even when main() bails out early with an exception.
+    try:
+        args = parse_args()
+        home = Path(args.home).expanduser().resolve()
+        target_config = home / ".config" / "opencode" / "opencode.json"
+
+        source_config = SRC_DIR / "opencode.json"
+        source_data = load_json(source_config)
+        agent_names = set(source_data.get("agent", {}).keys())
+
+        if args.backup_dir:
+            backup_dir = Path(args.backup_dir).expanduser().resolve()
+        else:
+            backup_parent = Path(args.backup_parent).expanduser().resolve()
+            backup_dir = latest_backup_dir(backup_parent, args.backup_prefix)
+
+        if backup_dir and backup_dir.exists():
+            restored_opencode = restore_dir(backup_dir, ".opencode", home)
+            restored_config = restore_dir(backup_dir, ".config/opencode", home)
+
+            if not restored_config:
+                backup_config = backup_dir / ".config/opencode/opencode.json"
+                if backup_config.exists():
+                    target_config.parent.mkdir(parents=True, exist_ok=True)
+                    restore_from_backup(
+                        backup_dir, ".config/opencode/opencode.json", home
+                    )
+                else:
+                    remove_agents_from_config(agent_names, target_config, home)
+
+            if not restored_opencode:
+                # Most prompts share a parent, so create each directory once
+                # up front instead of once per restored file.
+                for rel_dir in PROMPT_PARENT_DIRS:
+                    if os.path.isdir(os.path.join(backup_dir, rel_dir)):
+                        os.makedirs(os.path.join(home, rel_dir), exist_ok=True)
+                for rel_path in PROMPT_FILES:
+                    restore_from_backup(backup_dir, rel_path, home)
+
+            wait_for_removals()
+            print(f"Restored from backup: {backup_dir}")
+            return 0
+
+        remove_agents_from_config(agent_names, target_config, home)
+        for rel_path in PROMPT_FILES:
+            target = os.path.join(home, rel_path)
+            if os.path.exists(target):
+                if os.path.isdir(target):
+                    shutil.rmtree(target)
+                else:
+                    os.unlink(target)
+                remove_empty_dirs(os.path.dirname(target), home)
+        print("Removed managed OpenCode migration files (no backups found).")
         return 0
-
-    remove_agents_from_config(agent_names, target_config, home)
-    for rel_path in PROMPT_FILES:
-        target = home / rel_path
-        if target.exists():
-            if target.is_dir():
-                shutil.rmtree(target)
-            else:
-                target.unlink()
-            remove_empty_dirs(target.parent, home)
-    print("Removed managed OpenCode migration files (no backups found).")
-    return 0
+    finally:
+        wait_for_removals()
 
 
 if __name__ == "__main__":